@@ -1,6 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 from mmrazor.models.builder import ALGORITHMS
-from mmrazor.models.utils import add_prefix
 from .base import BaseAlgorithm
 
 
@@ -26,29 +25,28 @@ class GeneralDistill(BaseAlgorithm):
 
     def train_step(self, data, optimizer):
         """"""
-        losses = dict()
+        # Run the forwards even if their losses are not used, just to be
+        # able to trigger the forward hooks that have been registered. The
+        # teacher's forward is skipped if nothing of it is used.
+        teacher_forward = \
+            self.with_teacher_loss or self.distiller.needs_teacher
+        teacher_losses, student_losses = self.distiller.exec_forward(
+            self.architecture, data, teacher_forward)
+
+        prefixed_losses = list()
         if self.with_teacher_loss:
-            teacher_losses = self.distiller.exec_teacher_forward(data)
-            teacher_losses = add_prefix(teacher_losses, 'teacher')
-            losses.update(teacher_losses)
-        else:
-            # Just to be able to trigger the forward hooks that
-            # have been registered
-            _ = self.distiller.exec_teacher_forward(data)
-
+            prefixed_losses.append(('teacher', teacher_losses))
         if self.with_student_loss:
-            student_losses = self.distiller.exec_student_forward(
-                self.architecture, data)
-            student_losses = add_prefix(student_losses, 'student')
-            losses.update(student_losses)
-        else:
-            # Just to be able to trigger the forward hooks that
-            # have been registered
-            _ = self.distiller.exec_student_forward(self.architecture, data)
-
+            prefixed_losses.append(('student', student_losses))
         distill_losses = self.distiller.compute_distill_loss(data)
-        distill_losses = add_prefix(distill_losses, 'distiller')
-        losses.update(distill_losses)
+        prefixed_losses.append(('distiller', distill_losses))
+
+        # Build the final dict at once instead of merging prefixed copies.
+        losses = {
+            f'{prefix}.{name}': value
+            for prefix, part_losses in prefixed_losses
+            for name, value in part_losses.items()
+        }
 
         loss, log_vars = self._parse_losses(losses)
         outputs = dict(
@@ -31,6 +31,10 @@ def function_wrapper(ctx, method, method_str):
 class FunctionContext():
     """Function context manager for rewrite function.
 
+    The owner of the function and its wrapper are resolved once here, so
+    that entering and exiting the context at every iteration only swap an
+    attribute.
+
     Args:
         ctx (ConversionContext): The distiller's overall context manager.
         method (str): The name of the function to rewrite.
@@ -41,29 +45,39 @@ class FunctionContext():
 
         self.import_module = import_modules_from_strings(import_module)
         self.method_str = method
-        self.method_exec_str = f'self.import_module.{method}'
+
+        *owner_names, self.method_name = method.split('.')
+        self.method_owner = self.import_module
+        for owner_name in owner_names:
+            self.method_owner = getattr(self.method_owner, owner_name)
+        self.method_impl = getattr(self.method_owner, self.method_name)
+
+        self.method_wrapper = None
+        if self.method_impl:
+            self.method_wrapper = function_wrapper(self.ctx, self.method_impl,
+                                                   self.method_str)
 
     def _set_method(self, method):
         """Modify a function."""
-        exec(f'{self.method_exec_str} = method')
+        setattr(self.method_owner, self.method_name, method)
 
     def __enter__(self):
         """Rewrite the function."""
-        self.method_impl = eval(self.method_exec_str)
-
-        if self.method_impl:
-            self._set_method(
-                function_wrapper(self.ctx, self.method_impl, self.method_str,
-                                 self.align_mode))
+        if self.method_wrapper is not None:
+            self._set_method(self.method_wrapper)
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Restore the function."""
-        if self.method_impl:
+        if self.method_wrapper is not None:
             self._set_method(self.method_impl)
 
 
 class ConversionContext():
-    """Context manager for record functions' inputs or outputs."""
+    """Context manager for record functions' inputs or outputs.
+
+    The context manager is re-entrant, only the outermost ``with`` statement
+    rewrites and restores the functions.
+    """
 
     def __init__(self, hooks):
         # save functions' inputs
@@ -79,16 +93,22 @@ class ConversionContext():
         for hook in hooks:
             self.hooks.append(FunctionContext(self, **hook))
 
+        self._depth = 0
+
     def __enter__(self):
         """Enter every sub context managers."""
-        for hook in self.hooks:
-            hook.__enter__()
+        if self._depth == 0:
+            for hook in self.hooks:
+                hook.__enter__()
+        self._depth += 1
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Exit every sub context managers."""
-        for hook in self.hooks:
-            hook.__exit__(exc_type, exc_value, traceback)
+        self._depth -= 1
+        if self._depth == 0:
+            for hook in self.hooks:
+                hook.__exit__(exc_type, exc_value, traceback)
 
 
 class BaseDistiller(BaseModule, metaclass=ABCMeta):
@@ -134,6 +154,11 @@ class BaseDistiller(BaseModule, metaclass=ABCMeta):
         """Save the student output."""
         pass
 
+    @property
+    def needs_teacher(self):
+        """bool: Whether the distillation needs the teacher's forward."""
+        return True
+
     def reset_ctx_teacher_mode(self, mode=True):
         if self.context_manager is not None:
             self.context_manager.is_teacher = mode
@@ -148,6 +173,24 @@ class BaseDistiller(BaseModule, metaclass=ABCMeta):
         """Execute the student's forward function."""
         pass
 
+    def exec_forward(self, student, data, teacher_forward=True):
+        """Execute the teacher's and then the student's forward functions.
+
+        Args:
+            student (:obj:`torch.nn.Module`): The student model.
+            data (dict): The input data.
+            teacher_forward (bool): Whether to execute the teacher's forward.
+                If False, the teacher's output is None. Default: True.
+
+        Returns:
+            tuple: The outputs of the teacher and the student.
+        """
+        teacher_output = None
+        if teacher_forward:
+            teacher_output = self.exec_teacher_forward(data)
+        student_output = self.exec_student_forward(student, data)
+        return teacher_output, student_output
+
     @abstractmethod
     def compute_distill_loss(self, data):
         """Compute distill loss according teacher's outputs and student's
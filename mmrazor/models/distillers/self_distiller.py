@@ -42,10 +42,11 @@ class SelfDistiller(BaseDistiller):
             student (:obj:`torch.nn.Module`): The student model to be used
                 in the distillation.
         """
-        self.module2name = {}
-        for name, module in student.model.named_modules():
-            self.module2name[module] = name
         self.name_modules = dict(student.model.named_modules())
+        self.module2name = {
+            module: name
+            for name, module in self.name_modules.items()
+        }
 
         for component in self.components:
             student_module_name = component['student_module']
@@ -115,6 +116,29 @@ class SelfDistiller(BaseDistiller):
 
         return output
 
+    def exec_forward(self, student, data, teacher_forward=True):
+        """Execute the forward functions of the model as the teacher and then
+        as the student.
+
+        The teacher and the student are the same model, so ``student`` is
+        also passed to :meth:`exec_teacher_forward`.
+
+        Args:
+            student (:obj:`torch.nn.Module`): The model to be used in the
+                distillation.
+            data (dict): The output of dataloader.
+            teacher_forward (bool): Whether to execute the teacher's forward.
+                If False, the teacher's output is None. Default: True.
+
+        Returns:
+            tuple: The outputs of the teacher and the student.
+        """
+        teacher_output = None
+        if teacher_forward:
+            teacher_output = self.exec_teacher_forward(student, data)
+        student_output = self.exec_student_forward(student, data)
+        return teacher_output, student_output
+
     def compute_distill_loss(self, data):
         """Compute the distillation loss."""
 
@@ -1,4 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import copy
+
 import torch
 import torch.nn as nn
 from torch.nn.modules.batchnorm import _BatchNorm
@@ -7,6 +9,62 @@ from ..builder import DISTILLERS, MODELS, build_loss
 from .base import BaseDistiller
 
 
+def apply_to_tensors(data, function):
+    """Apply ``function`` to every tensor in the nested ``data``.
+
+    The containers keep their types, including namedtuples and dicts with
+    extra constructor arguments such as ``defaultdict``.
+    """
+    if isinstance(data, torch.Tensor):
+        return function(data)
+    elif isinstance(data, tuple) and hasattr(data, '_fields'):
+        return type(data)(*(apply_to_tensors(d, function) for d in data))
+    elif isinstance(data, (list, tuple)):
+        return type(data)(apply_to_tensors(d, function) for d in data)
+    elif isinstance(data, dict):
+        outputs = copy.copy(data)
+        for k, v in data.items():
+            outputs[k] = apply_to_tensors(v, function)
+        return outputs
+    return data
+
+
+def float_tensors(data):
+    """Cast the floating point tensors in ``data`` to FP32."""
+
+    def to_float(tensor):
+        if tensor.is_floating_point():
+            return tensor.float()
+        return tensor
+
+    return apply_to_tensors(data, to_float)
+
+
+class DistillComponent:
+    """A component of ``SingleTeacherDistiller`` resolved for the forward.
+
+    The named attributes make the loops of ``compute_distill_loss`` easier
+    to read than unpacking positional tuples.
+
+    Args:
+        student_records (list): The recorded outputs of the student module.
+        teacher_records (list): The recorded outputs of the teacher module.
+        align_module (:obj:`torch.nn.Module`, optional): The module to align
+            the student's outputs with the teacher's.
+        losses (tuple[tuple[str, :obj:`torch.nn.Module`]]): The names and the
+            modules of the losses of the component.
+    """
+
+    __slots__ = ('student_records', 'teacher_records', 'align_module',
+                 'losses')
+
+    def __init__(self, student_records, teacher_records, align_module, losses):
+        self.student_records = student_records
+        self.teacher_records = teacher_records
+        self.align_module = align_module
+        self.losses = losses
+
+
 @DISTILLERS.register_module()
 class SingleTeacherDistiller(BaseDistiller):
     """Distiller with single teacher.
@@ -21,6 +79,36 @@ class SingleTeacherDistiller(BaseDistiller):
         components (dict): The details of the distillation. It usually includes
             the module names of the teacher and the student, and the losses
             used in the distillation.
+        compile_cfg (dict, optional): The keyword arguments passed to
+            ``torch.compile`` to compile :meth:`exec_forward`, so that the
+            teacher's and the student's forwards are captured in a single
+            compiled region. The forward hooks of the distillation become
+            graph breaks, so ``fullgraph`` should be kept False. If None, the
+            forwards run eagerly. Default: None.
+        loss_compile_cfg (dict, optional): The keyword arguments passed to
+            ``torch.compile`` to compile the computation of all distillation
+            losses as a single graph, so that their small kernels can be
+            fused. The whole graph is captured by default. If None, the
+            losses run eagerly. Default: None.
+        tf32 (bool, optional): Whether to allow TF32 in the CUDA matmuls and
+            cuDNN convolutions on Ampere and newer GPUs. True roughly doubles
+            the throughput of the teacher's and the student's forwards, False
+            gives bit-exact FP32 results. Both backend flags are set to this
+            value, note that they are global to the process. If None, the
+            flags are left untouched, so TF32 is opt-in and building a
+            distiller has no side effect by default. Default: None.
+        amp_dtype (str | torch.dtype, optional): The dtype of
+            ``torch.autocast`` around the teacher's and the student's
+            forwards, e.g. ``'bfloat16'``. The device type of autocast
+            follows the inputs. The distillation losses are still computed
+            in FP32 for stability. If None, autocast is disabled.
+            Default: None.
+        async_teacher (bool): Whether to run the teacher's forward on a side
+            CUDA stream, overlapping with the student's forward on the
+            current stream. It is skipped on CPU and with ``align_methods``,
+            whose rewritten functions pass the teacher's outputs to the
+            student. Can't be used together with ``compile_cfg``.
+            Default: False.
     """
 
     def __init__(self,
@@ -28,12 +116,56 @@ class SingleTeacherDistiller(BaseDistiller):
                  teacher_trainable=False,
                  teacher_norm_eval=True,
                  components=tuple(),
+                 compile_cfg=None,
+                 loss_compile_cfg=None,
+                 tf32=None,
+                 amp_dtype=None,
+                 async_teacher=False,
                  **kwargs):
         super().__init__(**kwargs)
+        self.tf32 = tf32
+        if tf32 is not None:
+            assert hasattr(torch.backends.cuda, 'matmul'), \
+                '`tf32` needs PyTorch >= 1.7.'
+            torch.backends.cuda.matmul.allow_tf32 = bool(tf32)
+            torch.backends.cudnn.allow_tf32 = bool(tf32)
+
+        if amp_dtype is not None:
+            assert hasattr(torch, 'autocast'), \
+                '`amp_dtype` needs PyTorch >= 1.10.'
+        if isinstance(amp_dtype, str):
+            amp_dtype = getattr(torch, amp_dtype)
+        self.amp_dtype = amp_dtype
+
+        assert not (async_teacher and compile_cfg is not None), \
+            '`async_teacher` and `compile_cfg` can not be used together.'
+        self.async_teacher = async_teacher
+        # Created at the first forward, on the device used for training.
+        self._teacher_stream = None
+
         self.teacher_trainable = teacher_trainable
+        # The outputs of a frozen teacher are detached when recorded, so that
+        # they never keep a teacher's autograd graph alive, e.g. when the
+        # teacher runs in an algorithm's own grad mode.
+        self.detach_teacher_outputs = not teacher_trainable
         self.teacher_norm_eval = teacher_norm_eval
         self.teacher = self.build_teacher(teacher)
 
+        self.compile_cfg = compile_cfg
+        self.loss_compile_cfg = loss_compile_cfg
+        self._compile_functions()
+
+        # ``teacher_trainable`` is fixed during training, so the specialized
+        # teacher's forward is bound once instead of being branched at every
+        # iteration. The overrides of subclasses are kept.
+        if type(self).exec_teacher_forward is \
+                SingleTeacherDistiller.exec_teacher_forward:
+            if teacher_trainable:
+                self.exec_teacher_forward = \
+                    self._exec_trainable_teacher_forward
+            else:
+                self.exec_teacher_forward = self._exec_frozen_teacher_forward
+
         self.components = components
         self.losses = nn.ModuleDict()
         self.align_modules = nn.ModuleDict()
@@ -42,17 +174,28 @@ class SingleTeacherDistiller(BaseDistiller):
         self.student_outputs = dict()
         self.teacher_outputs = dict()
 
+        # The static part of ``compute_distill_loss``, resolved once here so
+        # that the components' configs are not traversed at every iteration.
+        # The modules are still registered in ``align_modules`` and ``losses``
+        # for the state dict, the plan only holds extra references to them.
+        loss_plan = list()
+        loss_names = set()
+
         for i, component in enumerate(self.components):
             student_module_name = component['student_module']
             teacher_module_name = component['teacher_module']
             # The type of every student_output is a list by default, because
             # some modules will execute multiple forward calculations, such as
-            # the shareable head in Retinanet
-            self.student_outputs[student_module_name] = list()
-            self.teacher_outputs[teacher_module_name] = list()
+            # the shareable head in Retinanet. The lists are only cleared in
+            # place, so that the loss plan could hold them directly.
+            student_records = self.student_outputs.setdefault(
+                student_module_name, list())
+            teacher_records = self.teacher_outputs.setdefault(
+                teacher_module_name, list())
 
             # If the number of featuremap channels of student and teacher are
             # inconsistent, they need to be aligned by a 1x1 convolution
+            align_module = None
             align_module_cfg = getattr(component, 'align_module', None)
             if align_module_cfg is not None:
                 align_module_name = f'component_{i}'
@@ -60,10 +203,25 @@ class SingleTeacherDistiller(BaseDistiller):
                 self.align_modules[align_module_name] = align_module
 
             # Multiple losses can be calculated at the same location
+            loss_modules = list()
             for loss in component.losses:
                 loss_cfg = loss.copy()
                 loss_name = loss_cfg.pop('name')
-                self.losses[loss_name] = build_loss(loss_cfg)
+                assert loss_name not in loss_names, \
+                    f'The loss name `{loss_name}` is duplicated.'
+                loss_names.add(loss_name)
+                loss_module = build_loss(loss_cfg)
+                self.losses[loss_name] = loss_module
+                loss_modules.append((loss_name, loss_module))
+
+            loss_plan.append(
+                DistillComponent(student_records, teacher_records,
+                                 align_module, tuple(loss_modules)))
+
+        self._loss_plan = tuple(loss_plan)
+        # Could be set to False by hooks to skip the teacher's forward, e.g.
+        # in a warmup phase without distillation.
+        self.teacher_enabled = True
 
     def build_teacher(self, cfg):
         """Build a model from the `cfg`."""
@@ -72,6 +230,62 @@ class SingleTeacherDistiller(BaseDistiller):
 
         return teacher
 
+    def compile_function(self, function, cfg):
+        """Compile ``function`` by ``torch.compile`` according to ``cfg``.
+
+        CUDA graphs of inductor are disabled by default, because the forward
+        hooks of the distiller mutate python state between calls, which
+        breaks the replay.
+
+        Args:
+            function (Callable): The function to compile.
+            cfg (dict): The keyword arguments passed to ``torch.compile``.
+        """
+        assert hasattr(torch, 'compile'), \
+            '`torch.compile` is only available in PyTorch >= 2.0.'
+
+        compile_cfg = dict(fullgraph=False, dynamic=True)
+        compile_cfg.update(cfg)
+        # ``mode`` only applies to inductor, and excludes ``options``.
+        if compile_cfg.get('backend', 'inductor') == 'inductor' \
+                and 'options' not in compile_cfg:
+            compile_cfg.setdefault('mode', 'max-autotune-no-cudagraphs')
+        return torch.compile(function, **compile_cfg)
+
+    def _compile_functions(self):
+        """Compile the functions configured by ``compile_cfg``.
+
+        The unbound functions are compiled and called with ``self``, so that
+        a copy of the distiller never runs the original's teacher and hooks.
+        No extra submodule is registered in the distiller's state dict.
+        """
+        self._compiled_exec_forward = None
+        if self.compile_cfg is not None:
+            self._compiled_exec_forward = self.compile_function(
+                BaseDistiller.exec_forward, self.compile_cfg)
+
+        self._compiled_compute_losses = None
+        if self.loss_compile_cfg is not None:
+            self._compiled_compute_losses = self.compile_function(
+                SingleTeacherDistiller._compute_losses, {
+                    'fullgraph': True,
+                    **self.loss_compile_cfg
+                })
+
+    def __getstate__(self):
+        # The compiled functions and the CUDA stream can't be pickled. The
+        # functions are compiled again by ``__setstate__``, the stream is
+        # created again at the first forward.
+        state = self.__dict__.copy()
+        state['_compiled_exec_forward'] = None
+        state['_compiled_compute_losses'] = None
+        state['_teacher_stream'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._compile_functions()
+
     def build_align_module(self, cfg):
         """Build ``align_module`` from the `cfg`.
 
@@ -101,30 +315,50 @@ class SingleTeacherDistiller(BaseDistiller):
         """
 
         # Record the mapping relationship between student's modules and module
-        # names.
-        self.student_module2name = {}
-        for name, module in student.model.named_modules():
-            self.student_module2name[module] = name
+        # names. Both mappings are built from a single traversal. The hooks
+        # look up their records in ``_student_module2records`` and
+        # ``_teacher_module2records`` instead, the ``module2name`` mappings
+        # are only kept as public attributes.
         self.student_name2module = dict(student.model.named_modules())
+        self.student_module2name = {
+            module: name
+            for name, module in self.student_name2module.items()
+        }
 
         # Record the mapping relationship between teacher's modules and module
         # names.
-        self.teacher_module2name = {}
-        for name, module in self.teacher.named_modules():
-            self.teacher_module2name[module] = name
         self.teacher_name2module = dict(self.teacher.named_modules())
+        self.teacher_module2name = {
+            module: name
+            for name, module in self.teacher_name2module.items()
+        }
+
+        # Validate the module names of all components at once.
+        missing_student_modules = \
+            self.student_outputs.keys() - self.student_name2module.keys()
+        assert not missing_student_modules, \
+            f'{sorted(missing_student_modules)} are not in the student.'
+        missing_teacher_modules = \
+            self.teacher_outputs.keys() - self.teacher_name2module.keys()
+        assert not missing_teacher_modules, \
+            f'{sorted(missing_teacher_modules)} are not in the teacher.'
 
         # Register forward hooks for modules that need to participate in loss
-        # calculation.
-        for component in self.components:
-            student_module_name = component['student_module']
-            teacher_module_name = component['teacher_module']
-
+        # calculation. The modules shared by several components are hooked
+        # only once, their recorded outputs are shared as well. Every hooked
+        # module is bound to its list of records, so that a hook only does a
+        # single lookup.
+        self._student_module2records = dict()
+        for student_module_name, records in self.student_outputs.items():
             student_module = self.student_name2module[student_module_name]
-            teacher_module = self.teacher_name2module[teacher_module_name]
-
+            self._student_module2records[student_module] = records
             student_module.register_forward_hook(
                 self.student_forward_output_hook)
+
+        self._teacher_module2records = dict()
+        for teacher_module_name, records in self.teacher_outputs.items():
+            teacher_module = self.teacher_name2module[teacher_module_name]
+            self._teacher_module2records[teacher_module] = records
             teacher_module.register_forward_hook(
                 self.teacher_forward_output_hook)
 
@@ -137,8 +371,11 @@ class SingleTeacherDistiller(BaseDistiller):
             outputs (tuple): The output of the module.
         """
         if self.training:
-            self.teacher_outputs[self.teacher_module2name[module]].append(
-                outputs)
+            # Nothing is attached to a graph when grad is disabled, e.g.
+            # under the default ``torch.no_grad`` of a frozen teacher.
+            if self.detach_teacher_outputs and torch.is_grad_enabled():
+                outputs = apply_to_tensors(outputs, torch.Tensor.detach)
+            self._teacher_module2records[module].append(outputs)
 
     def student_forward_output_hook(self, module, inputs, outputs):
         """Save the module's forward output.
@@ -149,13 +386,12 @@ class SingleTeacherDistiller(BaseDistiller):
             outputs (tuple): The output of the module.
         """
         if self.training:
-            self.student_outputs[self.student_module2name[module]].append(
-                outputs)
+            self._student_module2records[module].append(outputs)
 
     def reset_outputs(self, outputs):
         """Reset the teacher's outputs or student's outputs."""
         for key in outputs.keys():
-            outputs[key] = list()
+            outputs[key].clear()
 
     def exec_teacher_forward(self, data):
         """Execute the teacher's forward function.
@@ -164,18 +400,28 @@ class SingleTeacherDistiller(BaseDistiller):
         ``teacher_outputs``.
         """
 
+        if self.teacher_trainable:
+            return self._exec_trainable_teacher_forward(data)
+        return self._exec_frozen_teacher_forward(data)
+
+    def _exec_trainable_teacher_forward(self, data):
+        """Execute the forward function of a trainable teacher."""
         # Convert the context manager's mode to teacher.
         self.reset_ctx_teacher_mode(True)
         # Clear the saved data of the last forward。
         self.reset_outputs(self.teacher_outputs)
 
-        if self.teacher_trainable:
-            output = self.teacher(**data)
-        else:
-            with torch.no_grad():
-                output = self.teacher(**data)
+        return self._autocast_forward(self.teacher, data)
 
-        return output
+    def _exec_frozen_teacher_forward(self, data):
+        """Execute the forward function of a frozen teacher."""
+        # Convert the context manager's mode to teacher.
+        self.reset_ctx_teacher_mode(True)
+        # Clear the saved data of the last forward。
+        self.reset_outputs(self.teacher_outputs)
+
+        with torch.no_grad():
+            return self._autocast_forward(self.teacher, data)
 
     def exec_student_forward(self, student, data):
         """Execute the teacher's forward function.
@@ -188,9 +434,92 @@ class SingleTeacherDistiller(BaseDistiller):
         # Clear the saved data of the last forward。
         self.reset_outputs(self.student_outputs)
 
-        output = student(**data)
+        output = self._autocast_forward(student, data)
         return output
 
+    def _autocast_forward(self, model, data):
+        """Execute ``model``'s forward under autocast of ``amp_dtype``.
+
+        The device type of autocast follows the input tensors, so that it
+        also takes effect on CPU.
+        """
+        if self.amp_dtype is None:
+            return model(**data)
+
+        device_type = self._get_device_type(data)
+        with torch.autocast(device_type=device_type, dtype=self.amp_dtype):
+            return model(**data)
+
+    @staticmethod
+    def _get_device_type(data):
+        """Get the device type of the first input tensor in ``data``."""
+        for value in data.values():
+            if isinstance(value, torch.Tensor):
+                return value.device.type
+        return 'cpu'
+
+    @property
+    def needs_teacher(self):
+        """bool: Whether the distillation needs the teacher's forward.
+
+        The functions rewritten by the context manager always pass the
+        teacher's outputs to the student, so the teacher can't be skipped in
+        this case.
+        """
+        if self.context_manager is not None:
+            return True
+        return self.teacher_enabled and len(self._loss_plan) > 0
+
+    def exec_forward(self, student, data, teacher_forward=True):
+        """Execute the teacher's and the student's forward functions.
+
+        If ``compile_cfg`` is set, both forwards run in the same compiled
+        region, so that their kernels can be scheduled back-to-back.
+        """
+        if not teacher_forward:
+            # Drop the teacher's outputs of the last forward, so that the
+            # stale featuremaps are not distilled.
+            self.reset_outputs(self.teacher_outputs)
+
+        if self._compiled_exec_forward is not None:
+            return self._compiled_exec_forward(self, student, data,
+                                               teacher_forward)
+        if (teacher_forward and self.async_teacher
+                and self.context_manager is None
+                and self._get_device_type(data) == 'cuda'):
+            return self._exec_forward_async(student, data)
+        return super().exec_forward(student, data, teacher_forward)
+
+    def _exec_forward_async(self, student, data):
+        """Execute the teacher's forward on a side stream, overlapping with
+        the student's forward on the current stream."""
+        if self._teacher_stream is None:
+            self._teacher_stream = torch.cuda.Stream()
+        teacher_stream = self._teacher_stream
+        current_stream = torch.cuda.current_stream()
+
+        # The inputs are prepared on the current stream.
+        teacher_stream.wait_stream(current_stream)
+        with torch.cuda.stream(teacher_stream):
+            teacher_output = self.exec_teacher_forward(data)
+
+        student_output = self.exec_student_forward(student, data)
+        current_stream.wait_stream(teacher_stream)
+
+        # The teacher's outputs are consumed and freed on the current stream,
+        # the caching allocator must not reuse them for the side stream
+        # before that.
+        def record_stream(tensor):
+            if tensor.is_cuda:
+                tensor.record_stream(current_stream)
+            return tensor
+
+        apply_to_tensors(teacher_output, record_stream)
+        for records in self.teacher_outputs.values():
+            apply_to_tensors(records, record_stream)
+
+        return teacher_output, student_output
+
     def train(self, mode=True):
         """Set distiller's forward mode."""
         super(SingleTeacherDistiller, self).train(mode)
@@ -205,39 +534,72 @@ class SingleTeacherDistiller(BaseDistiller):
 
     def compute_distill_loss(self, data=None):
         """Compute the distillation loss."""
+        # Gathering the recorded outputs and passing ``data`` to the losses
+        # are python side effects, which are kept out of the compiled region
+        # of ``loss_compile_cfg``.
+        student_outputs = list()
+        teacher_outputs = list()
+        for component in self._loss_plan:
+            s_outs = component.student_records
+            t_outs = component.teacher_records
+            # The outputs recorded under autocast are cast back to FP32.
+            if self.amp_dtype is not None:
+                s_outs = float_tensors(s_outs)
+                t_outs = float_tensors(t_outs)
+            student_outputs.append(s_outs)
+            teacher_outputs.append(t_outs)
+            # TODO ugly implementation.
+            # Pass the gt_label to loss function.
+            # Only used by WSLD.
+            for _, loss_module in component.losses:
+                loss_module.current_data = data
+
+        if self._compiled_compute_losses is None:
+            loss_values = self._compute_losses(student_outputs,
+                                               teacher_outputs)
+        else:
+            loss_values = self._compiled_compute_losses(
+                self, student_outputs, teacher_outputs)
+        loss_values = iter(loss_values)
 
         losses = dict()
 
-        for i, component in enumerate(self.components):
-            # Get the student's outputs.
-            student_module_name = component['student_module']
-            student_outputs = self.student_outputs[student_module_name]
+        for component, s_outs, t_outs in zip(self._loss_plan, student_outputs,
+                                             teacher_outputs):
+            for out_idx in range(min(len(s_outs), len(t_outs))):
+                for loss_name, _ in component.losses:
+                    losses[f'{loss_name}.{out_idx}'] = next(loss_values)
+            for _, loss_module in component.losses:
+                loss_module.current_data = None
 
+        return losses
+
+    def _compute_losses(self, student_outputs, teacher_outputs):
+        """Compute the distillation losses from the recorded outputs.
+
+        Args:
+            student_outputs (list[list]): The student's outputs of every
+                component in ``self._loss_plan``.
+            teacher_outputs (list[list]): The teacher's outputs of every
+                component in ``self._loss_plan``.
+
+        Returns:
+            tuple[torch.Tensor]: The losses, flattened in the order of
+                components, outputs and losses.
+        """
+        loss_values = list()
+
+        for component, s_outs, t_outs in zip(self._loss_plan, student_outputs,
+                                             teacher_outputs):
             # Align student output's channels with teacher.
-            align_module_name = f'component_{i}'
-            if align_module_name in self.align_modules:
-                align_module = self.align_modules[align_module_name]
-                student_outputs = [
-                    align_module(s_out) for s_out in student_outputs
-                ]
-
-            # Get the teacher's outputs.
-            teacher_module_name = component['teacher_module']
-            teacher_outputs = self.get_teacher_outputs(teacher_module_name)
+            align_module = component.align_module
+            if align_module is not None:
+                s_outs = [align_module(s_out) for s_out in s_outs]
 
             # One module maybe have N outputs, such as the shareable head in
             # RetinaNet.
-            for out_idx, (s_out, t_out) in enumerate(
-                    zip(student_outputs, teacher_outputs)):
-
-                for loss in component.losses:
-                    loss_module = self.losses[loss.name]
-                    loss_name = f'{loss.name}.{out_idx}'
-                    # TODO ugly implementation.
-                    # Pass the gt_label to loss function.
-                    # Only used by WSLD.
-                    loss_module.current_data = data
-                    losses[loss_name] = loss_module(s_out, t_out)
-                    loss_module.current_data = None
+            for s_out, t_out in zip(s_outs, t_outs):
+                for _, loss_module in component.losses:
+                    loss_values.append(loss_module(s_out, t_out))
 
-        return losses
+        return tuple(loss_values)
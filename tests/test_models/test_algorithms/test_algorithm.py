@@ -1,10 +1,12 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import os
+import pickle
 from copy import deepcopy
 from os.path import dirname
 
 import mmcv
 import numpy as np
+import pytest
 import torch
 from mmcv import Config, ConfigDict
 
@@ -110,6 +112,17 @@ def test_autoslim_pretrain():
     losses = model(imgs, return_loss=True, gt_label=label)
     assert losses['loss'].item() > 0
 
+    # test the teacher's and the student's forwards of the self distiller
+    model.pruner.set_max_channel()
+    teacher_losses, student_losses = model.distiller.exec_forward(
+        model.architecture, {
+            'img': imgs,
+            'gt_label': label
+        })
+    assert teacher_losses.keys() == student_losses.keys()
+    assert len(model.distiller.teacher_outputs['head.fc']) == 1
+    assert len(model.distiller.student_outputs['head.fc']) == 1
+
 
 def test_autoslim_retrain():
     model_cfg = dict(
@@ -520,6 +533,13 @@ def test_rkd():
     losses = algorithm(imgs, return_loss=True, gt_label=label)
     assert losses['loss'].item() > 0
 
+    # test skipping the teacher's forward
+    algorithm.distiller.teacher_enabled = False
+    outputs = algorithm.train_step({'img': imgs, 'gt_label': label}, optimizer)
+    assert not any(
+        name.startswith('distiller') for name in outputs['log_vars'])
+    algorithm.distiller.teacher_enabled = True
+
     # test RelationalKD w/o l2 norm
     algorithm_cfg.distiller.components = [
         dict(
@@ -546,3 +566,327 @@ def test_rkd():
 
     losses = algorithm(imgs, return_loss=True, gt_label=label)
     assert losses['loss'].item() > 0
+
+
+def _rkd_algorithm_cfg(**distiller_kwargs):
+    student = dict(
+        type='mmcls.ImageClassifier',
+        backbone=dict(
+            type='ResNet',
+            depth=18,
+            num_stages=4,
+            out_indices=(3, ),
+            style='pytorch'),
+        neck=dict(type='GlobalAveragePooling'),
+        head=dict(
+            type='LinearClsHead',
+            num_classes=10,
+            in_channels=512,
+            loss=dict(type='CrossEntropyLoss', loss_weight=1.0),
+        ))
+    teacher = deepcopy(student)
+
+    distiller = dict(
+        type='SingleTeacherDistiller',
+        teacher=teacher,
+        teacher_trainable=False,
+        teacher_norm_eval=True,
+        components=[
+            dict(
+                student_module='neck.gap',
+                teacher_module='neck.gap',
+                losses=[
+                    dict(
+                        type='DistanceWiseRKD',
+                        name='distance_wise_loss',
+                        loss_weight=25.0,
+                        with_l2_norm=True),
+                    dict(
+                        type='AngleWiseRKD',
+                        name='angle_wise_loss',
+                        loss_weight=50.0,
+                        with_l2_norm=True),
+                ])
+        ])
+    distiller.update(distiller_kwargs)
+
+    return ConfigDict(
+        type='GeneralDistill',
+        architecture=dict(type='MMClsArchitecture', model=student),
+        with_student_loss=True,
+        with_teacher_loss=False,
+        distiller=distiller)
+
+
+def test_align_method_distill():
+    from mmcls.models.heads import ClsHead
+
+    algorithm_cfg = _rkd_algorithm_cfg(align_methods=[
+        dict(method='ClsHead.loss', import_module='mmcls.models.heads')
+    ])
+    algorithm_cfg.type = 'AlignMethodDistill'
+    algorithm = ALGORITHMS.build(algorithm_cfg)
+
+    imgs = torch.randn(16, 3, 32, 32)
+    label = torch.randint(0, 10, (16, ))
+    optimizer = torch.optim.SGD(algorithm.parameters(), lr=0.01)
+
+    original_loss = ClsHead.loss
+    outputs = algorithm.train_step({'img': imgs, 'gt_label': label}, optimizer)
+    assert outputs['loss'].item() > 0
+    # The student's loss is passed from the teacher.
+    assert 'ClsHead.loss' in algorithm.distiller.context_manager.method_return
+    assert ClsHead.loss is original_loss
+
+    # A nested ``with`` does not restore the function early.
+    context_manager = algorithm.distiller.context_manager
+    with context_manager:
+        assert ClsHead.loss is not original_loss
+        algorithm.train_step({'img': imgs, 'gt_label': label}, optimizer)
+        assert ClsHead.loss is not original_loss
+    assert ClsHead.loss is original_loss
+
+
+def test_single_teacher_distiller_components():
+    imgs = torch.randn(16, 3, 32, 32)
+    label = torch.randint(0, 10, (16, ))
+
+    # test duplicated loss names
+    algorithm_cfg = _rkd_algorithm_cfg()
+    losses = algorithm_cfg.distiller.components[0].losses
+    losses[1].name = losses[0].name
+    with pytest.raises(AssertionError):
+        ALGORITHMS.build(algorithm_cfg)
+
+    # test missing student module
+    algorithm_cfg = _rkd_algorithm_cfg()
+    algorithm_cfg.distiller.components[0].student_module = 'neck.missing'
+    with pytest.raises(AssertionError):
+        ALGORITHMS.build(algorithm_cfg)
+
+    # test missing teacher module
+    algorithm_cfg = _rkd_algorithm_cfg()
+    algorithm_cfg.distiller.components[0].teacher_module = 'neck.missing'
+    with pytest.raises(AssertionError):
+        ALGORITHMS.build(algorithm_cfg)
+
+    # test components sharing modules, which are recorded only once
+    algorithm_cfg = _rkd_algorithm_cfg()
+    component = algorithm_cfg.distiller.components[0]
+    shared_component = deepcopy(component)
+    component.losses = component.losses[:1]
+    shared_component.losses = shared_component.losses[1:]
+    algorithm_cfg.distiller.components.append(shared_component)
+    algorithm = ALGORITHMS.build(algorithm_cfg)
+
+    optimizer = torch.optim.SGD(algorithm.parameters(), lr=0.01)
+    outputs = algorithm.train_step({'img': imgs, 'gt_label': label}, optimizer)
+    distill_loss_names = [
+        name for name in outputs['log_vars'] if name.startswith('distiller')
+    ]
+    assert distill_loss_names == [
+        'distiller.distance_wise_loss.0', 'distiller.angle_wise_loss.0'
+    ]
+
+
+@pytest.mark.skipif(
+    not hasattr(torch, 'compile'), reason='torch.compile is not available')
+def test_single_teacher_distiller_compile_forward():
+    from mmrazor.models.distillers.base import BaseDistiller
+
+    algorithm_cfg = _rkd_algorithm_cfg(compile_cfg=dict(backend='eager'))
+    algorithm = ALGORITHMS.build(algorithm_cfg)
+    distiller = algorithm.distiller
+    assert distiller._compiled_exec_forward is not None
+
+    data = {
+        'img': torch.randn(16, 3, 32, 32),
+        'gt_label': torch.randint(0, 10, (16, ))
+    }
+
+    _, compiled_student_losses = distiller.exec_forward(
+        algorithm.architecture, data)
+    compiled_distill_losses = dict(distiller.compute_distill_loss(data))
+
+    _, student_losses = BaseDistiller.exec_forward(distiller,
+                                                   algorithm.architecture,
+                                                   data)
+    distill_losses = dict(distiller.compute_distill_loss(data))
+
+    assert compiled_student_losses.keys() == student_losses.keys()
+    for name, loss in student_losses.items():
+        assert torch.allclose(compiled_student_losses[name], loss)
+    assert len(distill_losses) == 2
+    assert compiled_distill_losses.keys() == distill_losses.keys()
+    for name, loss in distill_losses.items():
+        assert torch.allclose(compiled_distill_losses[name], loss)
+
+    # A copy runs its own teacher and records into its own outputs.
+    distiller.reset_outputs(distiller.teacher_outputs)
+    copied_algorithm = deepcopy(algorithm)
+    copied_distiller = copied_algorithm.distiller
+    assert copied_distiller._compiled_exec_forward is not None
+    copied_distiller.exec_forward(copied_algorithm.architecture, data)
+    assert len(copied_distiller.teacher_outputs['neck.gap']) == 1
+    assert len(distiller.teacher_outputs['neck.gap']) == 0
+
+    # The compiled functions are left out of the pickled state.
+    loaded_algorithm = pickle.loads(pickle.dumps(algorithm))
+    assert loaded_algorithm.distiller._compiled_exec_forward is not None
+
+
+@pytest.mark.skipif(
+    not hasattr(torch, 'compile'), reason='torch.compile is not available')
+def test_single_teacher_distiller_compile_losses():
+    algorithm_cfg = _rkd_algorithm_cfg(loss_compile_cfg=dict(backend='eager'))
+    algorithm = ALGORITHMS.build(algorithm_cfg)
+    distiller = algorithm.distiller
+    assert distiller._compiled_compute_losses is not None
+
+    data = {
+        'img': torch.randn(16, 3, 32, 32),
+        'gt_label': torch.randint(0, 10, (16, ))
+    }
+    distiller.exec_forward(algorithm.architecture, data)
+    compiled_losses = dict(distiller.compute_distill_loss(data))
+
+    # A copy computes the losses from its own recorded outputs.
+    copied_distiller = deepcopy(distiller)
+    assert copied_distiller._compiled_compute_losses is not None
+    distiller.reset_outputs(distiller.student_outputs)
+    assert len(copied_distiller.compute_distill_loss(data)) == 2
+    assert len(distiller.compute_distill_loss(data)) == 0
+    loaded_distiller = pickle.loads(pickle.dumps(copied_distiller))
+    assert loaded_distiller._compiled_compute_losses is not None
+    distiller.exec_forward(algorithm.architecture, data)
+
+    # Compute the losses eagerly from the same recorded outputs.
+    distiller._compiled_compute_losses = None
+    losses = dict(distiller.compute_distill_loss(data))
+
+    assert len(losses) == 2
+    assert compiled_losses.keys() == losses.keys()
+    for name, loss in losses.items():
+        assert torch.allclose(compiled_losses[name], loss)
+
+
+def test_single_teacher_distiller_async_teacher():
+    algorithm_cfg = _rkd_algorithm_cfg(
+        async_teacher=True, compile_cfg=dict(backend='eager'))
+    with pytest.raises(AssertionError):
+        ALGORITHMS.build(algorithm_cfg)
+
+    # The side stream is skipped with CPU inputs, even on a GPU host.
+    algorithm_cfg = _rkd_algorithm_cfg(async_teacher=True)
+    algorithm = ALGORITHMS.build(algorithm_cfg)
+    imgs = torch.randn(16, 3, 32, 32)
+    label = torch.randint(0, 10, (16, ))
+    optimizer = torch.optim.SGD(algorithm.parameters(), lr=0.01)
+    outputs = algorithm.train_step({'img': imgs, 'gt_label': label}, optimizer)
+    assert outputs['loss'].item() > 0
+    assert algorithm.distiller._teacher_stream is None
+
+
+def test_single_teacher_distiller_specialized_teacher_forward():
+    from mmrazor.models.distillers import SingleTeacherDistiller
+
+    algorithm = ALGORITHMS.build(_rkd_algorithm_cfg(teacher_trainable=False))
+    assert algorithm.distiller.exec_teacher_forward.__func__ is \
+        SingleTeacherDistiller._exec_frozen_teacher_forward
+
+    algorithm = ALGORITHMS.build(_rkd_algorithm_cfg(teacher_trainable=True))
+    assert algorithm.distiller.exec_teacher_forward.__func__ is \
+        SingleTeacherDistiller._exec_trainable_teacher_forward
+
+    # The overrides of subclasses are kept.
+    class ToyDistiller(SingleTeacherDistiller):
+
+        def exec_teacher_forward(self, data):
+            return 'toy'
+
+    distiller_cfg = _rkd_algorithm_cfg().distiller
+    distiller_cfg.pop('type')
+    distiller = ToyDistiller(**distiller_cfg)
+    assert distiller.exec_teacher_forward.__func__ is \
+        ToyDistiller.exec_teacher_forward
+    assert distiller.exec_teacher_forward(dict()) == 'toy'
+
+
+def test_single_teacher_distiller_detach_teacher_outputs():
+    from collections import defaultdict, namedtuple
+
+    algorithm = ALGORITHMS.build(_rkd_algorithm_cfg())
+    distiller = algorithm.distiller
+    distiller.train()
+    teacher_module = distiller.teacher_name2module['neck.gap']
+
+    Outputs = namedtuple('Outputs', ['feat', 'logits'])
+    weight = torch.randn(4, requires_grad=True)
+    outputs = Outputs(weight * 2, [weight * 3])
+    dict_outputs = defaultdict(list, feat=weight * 4)
+
+    # The outputs of a frozen teacher are detached if grad is enabled, the
+    # types of the containers are kept.
+    with torch.enable_grad():
+        distiller.teacher_forward_output_hook(teacher_module, (), outputs)
+        distiller.teacher_forward_output_hook(teacher_module, (),
+                                              dict_outputs)
+    records = distiller.teacher_outputs['neck.gap']
+    assert type(records[0]) is Outputs
+    assert type(records[0].logits) is list
+    assert not records[0].feat.requires_grad
+    assert not records[0].logits[0].requires_grad
+    assert type(records[1]) is defaultdict
+    assert records[1].default_factory is list
+    assert not records[1]['feat'].requires_grad
+
+    # The outputs of a trainable teacher are kept in the graph.
+    distiller.reset_outputs(distiller.teacher_outputs)
+    distiller.detach_teacher_outputs = False
+    with torch.enable_grad():
+        distiller.teacher_forward_output_hook(teacher_module, (), outputs)
+    assert records[0] is outputs
+    assert records[0].feat.requires_grad
+
+
+@pytest.mark.skipif(
+    not hasattr(torch.backends.cuda, 'matmul'),
+    reason='The TF32 flags are not available')
+def test_single_teacher_distiller_tf32():
+    matmul_allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+    cudnn_allow_tf32 = torch.backends.cudnn.allow_tf32
+    try:
+        for tf32 in (True, False):
+            ALGORITHMS.build(_rkd_algorithm_cfg(tf32=tf32))
+            assert torch.backends.cuda.matmul.allow_tf32 is tf32
+            assert torch.backends.cudnn.allow_tf32 is tf32
+
+        # The flags are left untouched by default.
+        for allow_tf32 in (True, False):
+            torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+            torch.backends.cudnn.allow_tf32 = allow_tf32
+            ALGORITHMS.build(_rkd_algorithm_cfg())
+            assert torch.backends.cuda.matmul.allow_tf32 is allow_tf32
+            assert torch.backends.cudnn.allow_tf32 is allow_tf32
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = matmul_allow_tf32
+        torch.backends.cudnn.allow_tf32 = cudnn_allow_tf32
+
+
+@pytest.mark.skipif(
+    not hasattr(torch, 'autocast'), reason='torch.autocast is not available')
+def test_single_teacher_distiller_amp():
+    algorithm_cfg = _rkd_algorithm_cfg(amp_dtype='bfloat16')
+    algorithm = ALGORITHMS.build(algorithm_cfg)
+    assert algorithm.distiller.amp_dtype is torch.bfloat16
+
+    # The autocast follows the device of the inputs, the distillation losses
+    # are computed in FP32.
+    imgs = torch.randn(16, 3, 32, 32)
+    label = torch.randint(0, 10, (16, ))
+    optimizer = torch.optim.SGD(algorithm.parameters(), lr=0.01)
+    algorithm.train_step({'img': imgs, 'gt_label': label}, optimizer)
+    student_records = algorithm.distiller.student_outputs['neck.gap']
+    assert student_records[0].dtype == torch.bfloat16
+    distill_losses = algorithm.distiller.compute_distill_loss()
+    assert all(loss.dtype == torch.float32 for loss in distill_losses.values())